@@ -1,14 +1,20 @@
 #!/usr/bin/env python3
+import concurrent.futures
+import glob
+import hashlib
+import io
 import os
+import re
+import shutil
 import sys
-import tempfile
+import time
 
 import numpy as np
-import pygmt
-from pygmt.datasets import load_earth_relief
+import pandas as pd
+from lxml import etree
 
-from obspy.clients.fdsn import Client
-from obspy import UTCDateTime
+# pygmt, xarray and obspy are imported inside the functions that use them;
+# they are slow to import and a cached run never needs them.
 
 # ------------------------------------------------------------
 # CONFIG / CONSTANTS
@@ -27,9 +33,18 @@ NETWORK     = "SN"
 STATION_PAT = "IS*"     # all NTS infrasound array elements
 CHANNEL_PAT = "*DF"
 
+# Station coordinates are read from this CSV (code,lat,lon,network); only
+# query IRIS (and rewrite the CSV) when refreshing or if the CSV is missing
+STATION_CSV       = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sn_is_stations.csv")
+REFRESH_FROM_IRIS = False
+
 # Time window covering all SPE shots
-T_START = UTCDateTime(2011, 5, 3, 0, 0, 0)
-T_END   = UTCDateTime(2016,10,12,23,59,59)
+T_START = "2011-05-03T00:00:00"
+T_END   = "2016-10-12T23:59:59"
+
+# Local caches (StationXML inventory, earth_relief grids) live alongside GMT's own
+CACHE_DIR          = os.environ["GMT_REMOTE_CACHE"]
+INV_CACHE_MAX_DAYS = 30   # re-query IRIS once the cached inventory is older than this
 
 # Explosion epicenter (common SPE GT location) – currently not plotted
 EXP_LAT  = 37.2212
@@ -37,9 +52,10 @@ EXP_LON  = -116.0609
 EXP_NAME = "SPE"
 
 # Output
-SAVE      = False
+SAVE      = False   # with SAVE on, an unchanged map is copied from cache and not re-shown
 SAVE_PATH = "/Users/serinawang/Desktop/SPE1_LLNL"
 FNAME     = "SPE_station_map.png"
+SAVE_DPI  = 450
 
 # Region (lon_min, lon_max, lat_min, lat_max)
 # Set to None to auto-fit around stations (+ epicenter, if included).
@@ -61,14 +77,85 @@ FILL_INFRA = "black"
 FILL_STAR  = "red"
 PEN_SYM    = "black"
 
+# Legend spec (passed to fig.legend in-memory via io.StringIO; needs PyGMT >= 0.14)
+_LEGEND_SPEC = f"""\
+S 0.3c a 0.35c {FILL_STAR} 0.5p,{PEN_SYM} 0.9c Explosion ground truth
+S 0.3c h 0.32c {FILL_INFRA} 0.5p,{PEN_SYM} 0.9c Infrasound array
+"""
+
+# NTS array element codes: 'IS' + array_number + element_number (IS31 -> IS3)
+_IS_RE = re.compile(r"^(IS\d)")
+
 # Topography preference (tries in order; first that works is used)
 TOPO_PREF = ("01s", "03s", "15s")
+TOPO_SMALL_AREA = 0.01  # deg^2; larger regions start from the coarsest (always available) grid
+TOPO_CACHE_MAX_DAYS = 30     # re-fetch a cached earth_relief grid once it is older than this
+REFRESH_TOPO        = False  # True: ignore cached grids and re-fetch
 
 
 # ------------------------------------------------------------
 # HELPERS
 # ------------------------------------------------------------
 
+def _parse_station_xml(source):
+    """
+    Stream <Station> elements out of StationXML (path or file-like) and return
+    dict: {sta: {"lat": ..., "lon": ..., "network": ...}}
+    without building obspy's Inventory object model.
+    """
+    stations = {}
+    for _, el in etree.iterparse(source, tag="{*}Station"):
+        code = el.get("code")     # e.g., IS31, IS41, ...
+        stations[code] = {
+            "lat": float(el.findtext("{*}Latitude")),
+            "lon": float(el.findtext("{*}Longitude")),
+            "network": el.getparent().get("code"),
+        }
+        # free this Station and the already-parsed ones still attached to Network
+        el.clear()
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+    return stations
+
+
+def _write_cache(cache_path, write):
+    """
+    Call write(tmp_path) on a temp file next to cache_path, then move it into
+    place, so an interrupted write never leaves a truncated cache file behind.
+    """
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        print(f"[WARN] Could not write cache {cache_path}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def _write_bytes(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _inv_cache_path(source, network, station, channel, starttime, endtime):
+    """StationXML cache path in CACHE_DIR, keyed on the query parameters."""
+    cache_key = hashlib.sha1(
+        repr((source, network, station, channel, str(starttime), str(endtime))).encode()
+    ).hexdigest()
+    return os.path.join(CACHE_DIR, f"iris_inv_{cache_key}.xml")
+
+
+def _cache_fresh(cache_path, max_days):
+    """True if cache_path exists and is younger than max_days."""
+    if not os.path.exists(cache_path):
+        return False
+    age_days = (time.time() - os.path.getmtime(cache_path)) / 86400.0
+    return age_days < max_days
+
+
 def collect_stations_from_iris(
     source=FDSN_SOURCE,
     network=NETWORK,
@@ -76,36 +163,70 @@ def collect_stations_from_iris(
     channel=CHANNEL_PAT,
     starttime=T_START,
     endtime=T_END,
+    refresh=False,
+    on_query=None,
 ):
     """
     Query IRIS FDSN for SN.IS* stations and return
     dict: {sta: {"lat": ..., "lon": ..., "network": ...}}
+
+    The raw StationXML is cached in CACHE_DIR, keyed on the query
+    parameters, and reused until it is older than INV_CACHE_MAX_DAYS.
+    refresh=True skips the cache and always queries IRIS. on_query(), if
+    given, is called just before the network request (not on a cache hit).
     """
-    client = Client(source)
+    cache_path = _inv_cache_path(source, network, station, channel, starttime, endtime)
+
+    if not refresh and _cache_fresh(cache_path, INV_CACHE_MAX_DAYS):
+        try:
+            return _parse_station_xml(cache_path)
+        except Exception as e:
+            print(f"[WARN] Cached inventory unreadable ({e}); re-querying {source}.")
+
+    if on_query is not None:
+        on_query()
 
+    from obspy import UTCDateTime
+    from obspy.clients.fdsn import Client
+
+    client = Client(source)
+    buf = io.BytesIO()
     try:
-        inv = client.get_stations(
+        client.get_stations(
             network=network,
             station=station,
             channel=channel,
-            starttime=starttime,
-            endtime=endtime,
+            starttime=UTCDateTime(starttime),
+            endtime=UTCDateTime(endtime),
             level="station",
+            filename=buf,
         )
     except Exception as e:
         raise RuntimeError(f"FDSN get_stations failed: {e}")
 
-    stations = {}
-    for net in inv:
-        for sta in net.stations:
-            code = sta.code     # e.g., IS31, IS41, ...
-            lat = sta.latitude
-            lon = sta.longitude
-            stations[code] = {
-                "lat": float(lat),
-                "lon": float(lon),
-                "network": net.code,
-            }
+    _write_cache(cache_path, lambda tmp_path: _write_bytes(tmp_path, buf.getvalue()))
+
+    buf.seek(0)
+    return _parse_station_xml(buf)
+
+
+def load_stations(csv_path=STATION_CSV, refresh=False, on_query=None):
+    """
+    Return station dict {sta: {"lat": ..., "lon": ..., "network": ...}}
+    from csv_path. Falls back to collect_stations_from_iris() (and rewrites
+    the CSV) when refresh is True or the CSV doesn't exist yet; refresh also
+    bypasses the StationXML cache so IRIS is actually re-queried.
+    on_query is passed through to collect_stations_from_iris().
+    """
+    if not refresh and os.path.exists(csv_path):
+        df = pd.read_csv(csv_path, dtype={"code": str, "network": str})
+        return df.set_index("code").to_dict("index")
+
+    stations = collect_stations_from_iris(refresh=refresh, on_query=on_query)
+    if stations:
+        df = pd.DataFrame.from_dict(stations, orient="index")
+        df.index.name = "code"
+        df[["lat", "lon", "network"]].to_csv(csv_path)
     return stations
 
 
@@ -119,39 +240,24 @@ def group_arrays(infra_raw):
 
     Returns dict: {array_id: {"lat": mean_lat, "lon": mean_lon}}
     """
-    groups = {}
-    for sta, info in infra_raw.items():
-        # Default: use full station code if not in IS## pattern
-        array_id = sta
-        # Simple pattern for NTS arrays: 'IS' + array_number + element_number
-        # e.g., IS31 -> IS3, IS41 -> IS4
-        if len(sta) >= 3 and sta.startswith("IS") and sta[2].isdigit():
-            array_id = sta[:3]  # 'IS3', 'IS4', etc.
-
-        groups.setdefault(array_id, {"lats": [], "lons": []})
-        groups[array_id]["lats"].append(info["lat"])
-        groups[array_id]["lons"].append(info["lon"])
-
-    grouped = {}
-    for arr, vals in groups.items():
-        grouped[arr] = {
-            "lat": float(np.mean(vals["lats"])),
-            "lon": float(np.mean(vals["lons"])),
-        }
-    return grouped
+    df = pd.DataFrame.from_dict(infra_raw, orient="index")
+    # IS31 -> IS3, IS41 -> IS4; anything else keeps its full code
+    array_ids = df.index.str.extract(_IS_RE, expand=False)
+    df["array_id"] = array_ids.where(array_ids.notna(), df.index)
+    return df.groupby("array_id")[["lat", "lon"]].mean().to_dict("index")
 
 
 def compute_region_from_points(lats, lons, pad_min=0.01, pad_frac=0.01):
     """
     Build padded region [lon_min, lon_max, lat_min, lat_max]
-    around given lat/lon lists.
+    around given lat/lon arrays.
 
     pad_min and pad_frac are set smaller than before to 'zoom in' a bit.
     """
-    lats = list(lats)
-    lons = list(lons)
-    lat_min, lat_max = min(lats), max(lats)
-    lon_min, lon_max = min(lons), max(lons)
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    lat_min, lat_max = float(lats.min()), float(lats.max())
+    lon_min, lon_max = float(lons.min()), float(lons.max())
 
     dlat = max(lat_max - lat_min, pad_min)
     dlon = max(lon_max - lon_min, pad_min)
@@ -161,42 +267,97 @@ def compute_region_from_points(lats, lons, pad_min=0.01, pad_frac=0.01):
     return [lon_min - lon_pad, lon_max + lon_pad, lat_min - lat_pad, lat_max + lat_pad]
 
 
-def load_topography(region):
+def _topo_cache_path(res, region):
+    """NetCDF cache path in CACHE_DIR for one (resolution, region) subset."""
+    cache_key = hashlib.sha1(repr((res, tuple(region))).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"earth_relief_{cache_key}.nc")
+
+
+def _topo_order(region):
     """
-    Try multiple earth_relief resolutions in TOPO_PREF order.
-    Return the first that works.
+    Resolution order for this region: TOPO_PREF as-is for small regions,
+    reversed (coarsest first) otherwise.
     """
+    area_deg2 = (region[1] - region[0]) * (region[3] - region[2])
+    return TOPO_PREF if area_deg2 < TOPO_SMALL_AREA else TOPO_PREF[::-1]
+
+
+def load_topography(region, refresh=False):
+    """
+    Try multiple earth_relief resolutions (see _topo_order).
+    Return (grid, resolution) for the first that works.
+
+    Grids are cached as NetCDF keyed by (resolution, region). A cached grid
+    younger than TOPO_CACHE_MAX_DAYS is reopened instead of fetching that
+    resolution; a lower resolution is only used once the preferred one has
+    been tried. refresh=True ignores the cache.
+    """
+    import xarray as xr
+    from pygmt.datasets import load_earth_relief
+
     last_err = None
-    for res in TOPO_PREF:
+    for res in _topo_order(region):
+        cache_path = _topo_cache_path(res, region)
+        if not refresh and _cache_fresh(cache_path, TOPO_CACHE_MAX_DAYS):
+            try:
+                # load (not open) so a damaged file fails here, not inside pygmt
+                return xr.load_dataarray(cache_path), res
+            except Exception as e:
+                print(f"[WARN] Cached topo unreadable ({e}); re-fetching {res}.")
         try:
-            return load_earth_relief(resolution=res, region=region)
+            grid = load_earth_relief(resolution=res, region=region)
         except Exception as e:
             last_err = e
             continue
+        _write_cache(cache_path, grid.to_netcdf)
+        return grid, res
     raise RuntimeError("Unable to load earth_relief for region. Last error: %s" % last_err)
 
 
-def write_legend_and_get_path():
+def _map_cache_path(region, infra):
     """
-    Create a temporary legend spec file and return its path.
-    Caller should remove the file after fig.legend().
-    """
-    legend_entries = f"""\
-S 0.3c a 0.35c {FILL_STAR} 0.5p,{PEN_SYM} 0.9c Explosion ground truth
-S 0.3c h 0.32c {FILL_INFRA} 0.5p,{PEN_SYM} 0.9c Infrasound array
-"""
-    tf = tempfile.NamedTemporaryFile("w", suffix=".leg", delete=False)
-    with tf:
-        tf.write(legend_entries)
-    return tf.name
-
+    Path in CACHE_DIR of the cached rendered map for this region + array set,
+    or None if it can't be cached (preferred-resolution topo grid not cached/fresh).
 
-def add_label(fig, lon, lat, text):
-    """Place a station/array label next to its symbol."""
+    The key also covers the topo grid file (path + mtime, so a re-fetched grid
+    re-renders) and a hash of this script, so editing any style constant,
+    frame string or SAVE_DPI invalidates it.
+    """
+    topo_path = _topo_cache_path(_topo_order(region)[0], region)
+    if REFRESH_TOPO or not _cache_fresh(topo_path, TOPO_CACHE_MAX_DAYS):
+        return None
+    with open(os.path.abspath(__file__), "rb") as f:
+        script_hash = hashlib.sha1(f.read()).hexdigest()
+    # (group_arrays already returns arrays in sorted order, no re-sort needed)
+    cache_key = hashlib.sha1(repr((
+        tuple(region),
+        tuple(infra.items()),
+        topo_path,
+        os.path.getmtime(topo_path),
+        script_hash,
+    )).encode()).hexdigest()
+    stem, ext = os.path.splitext(FNAME)
+    return os.path.join(CACHE_DIR, f"map_{stem}.{cache_key}{ext}")
+
+
+def _store_map_cache(out, cached_out):
+    """Copy the saved map to cached_out, dropping older cached renders of FNAME."""
+    stem, ext = os.path.splitext(FNAME)
+    for old in glob.glob(os.path.join(CACHE_DIR, f"map_{glob.escape(stem)}.*{glob.escape(ext)}")):
+        if old != cached_out:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+    _write_cache(cached_out, lambda tmp_path: shutil.copyfile(out, tmp_path))
+
+
+def add_labels(fig, lons, lats, texts):
+    """Place station/array labels next to their symbols (one GMT call)."""
     fig.text(
-        x=lon,
-        y=lat,
-        text=text,
+        x=np.asarray(lons),
+        y=np.asarray(lats),
+        text=list(texts),
         font=LABEL_FONT,
         offset=LABEL_OFFSET,
         justify=LABEL_JUSTIFY,
@@ -208,20 +369,22 @@ def add_label(fig, lon, lat, text):
 # ------------------------------------------------------------
 
 def main():
-    # GMT defaults (match PE1A style)
-    pygmt.config(
-        MAP_FRAME_TYPE="plain",
-        FORMAT_GEO_MAP="ddd.xx",
-        MAP_ANNOT_OBLIQUE="0",
-        FONT_LABEL="8p,Helvetica,black",
-        MAP_SCALE_HEIGHT="7p",
-    )
-
-    # Make scale bar line thicker
-    pygmt.config(MAP_TICK_PEN_PRIMARY="1.5p")  # try 2p, 3p, etc.
-
-    # Collect element station coordinates from IRIS
-    infra_raw = collect_stations_from_iris()
+    refresh_stations = REFRESH_FROM_IRIS
+
+    # With a fixed region the topo fetch doesn't depend on the stations, so
+    # if an IRIS query actually runs, start it alongside and let the two overlap
+    # (CSV / StationXML cache hits have nothing to overlap with)
+    topo_future = None
+
+    def prefetch_topo():
+        nonlocal topo_future
+        if MANUAL_REGION is not None:
+            topo_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            topo_future = topo_pool.submit(load_topography, MANUAL_REGION, REFRESH_TOPO)
+            topo_pool.shutdown(wait=False)
+
+    # Collect element station coordinates (shipped CSV, or IRIS on refresh)
+    infra_raw = load_stations(refresh=refresh_stations, on_query=prefetch_topo)
     if not infra_raw:
         raise RuntimeError("No SN.IS* stations found from IRIS query.")
 
@@ -232,19 +395,54 @@ def main():
     if MANUAL_REGION is not None:
         region = MANUAL_REGION
     else:
-        all_lats = [v["lat"] for v in infra.values()]
-        all_lons = [v["lon"] for v in infra.values()]
+        all_lats = np.fromiter((v["lat"] for v in infra.values()), dtype=np.float64)
+        all_lons = np.fromiter((v["lon"] for v in infra.values()), dtype=np.float64)
         # If you want epicenter to influence window, uncomment below
         # if EXP_LAT is not None and EXP_LON is not None:
-        #     all_lats.append(EXP_LAT)
-        #     all_lons.append(EXP_LON)
+        #     all_lats = np.append(all_lats, EXP_LAT)
+        #     all_lons = np.append(all_lons, EXP_LON)
         region = compute_region_from_points(all_lats, all_lons)
 
+    # Rendered map is cached in CACHE_DIR (see _map_cache_path); on a hit
+    # there's nothing to redraw, so copy it to FNAME and skip GMT (and
+    # fig.show()) entirely.
+    cached_out = _map_cache_path(region, infra) if SAVE else None
+    if cached_out is not None and os.path.exists(cached_out):
+        out = os.path.join(SAVE_PATH, FNAME)
+        shutil.copyfile(cached_out, out)
+        print(f"Saved (cached): {out}")
+        return
+
+    # Background topo. Collect it before the first pygmt call so the prefetch
+    # thread's GMT session is finished before the main thread opens one.
+    try:
+        if topo_future is not None:
+            grid, topo_res = topo_future.result()
+        else:
+            grid, topo_res = load_topography(region, REFRESH_TOPO)
+    except Exception as e:
+        print(f"[WARN] Topo load failed: {e}")
+        grid, topo_res = None, None
+
+    import pygmt
+
+    # GMT defaults (match PE1A style)
+    pygmt.config(
+        MAP_FRAME_TYPE="plain",
+        FORMAT_GEO_MAP="ddd.xx",
+        MAP_ANNOT_OBLIQUE="0",
+        FONT_LABEL="8p,Helvetica,black",
+        MAP_SCALE_HEIGHT="7p",
+    )
+
+    # Make scale bar line thicker
+    pygmt.config(MAP_TICK_PEN_PRIMARY="1.5p")  # try 2p, 3p, etc.
+
     fig = pygmt.Figure()
 
-    # Background topo
     try:
-        grid = load_topography(region)
+        if grid is None:
+            raise RuntimeError("no topo grid")
         fig.grdimage(
             grid,
             region=region,
@@ -254,26 +452,21 @@ def main():
             frame=["xa0.02.02+lLongitude", "ya0.02.02+lLatitude"],
         )
     except Exception as e:
-        print(f"[WARN] Topo load failed: {e}\nFalling back to coast basemap.")
+        print(f"[WARN] Topo plot failed: {e}\nFalling back to coast basemap.")
+        topo_res = None  # don't cache a coast-basemap render as the topo map
         fig.basemap(region=region, projection=PROJECTION,
                     frame=["xaf+lLongitude", "yaf+lLatitude"])
         fig.coast(land="lightgray", water="lightblue", shorelines=True)
 
-    # Plot arrays as single hexagons at centroids with numeric labels only
-    for arr, info in sorted(infra.items()):
-        fig.plot(
-            x=info["lon"], y=info["lat"],
-            style=SYM_HEX,
-            fill=FILL_INFRA,
-            pen=PEN_SYM,
-        )
+    # Plot arrays as single hexagons at centroids (one GMT call) with numeric labels only
+    lons = np.fromiter((v["lon"] for v in infra.values()), dtype=np.float64)
+    lats = np.fromiter((v["lat"] for v in infra.values()), dtype=np.float64)
+    fig.plot(x=lons, y=lats, style=SYM_HEX, fill=FILL_INFRA, pen=PEN_SYM)
 
-        # Convert 'IS3' -> '3', 'IS4' -> '4', else keep original
-        label_text = arr
-        if arr.startswith("IS") and len(arr) >= 3 and arr[2].isdigit():
-            label_text = arr[2]
+    # Convert 'IS3' -> '3', 'IS4' -> '4', else keep original
+    labels = [arr[2] if _IS_RE.match(arr) else arr for arr in infra]
 
-        # add_label(fig, info["lon"], info["lat"], label_text)
+    # add_labels(fig, lons, lats, labels)
 
     # Explosion epicenter (currently off)
     if EXP_LAT is not None and EXP_LON is not None:
@@ -291,20 +484,21 @@ def main():
     # Scale bar & legend
     fig.basemap(map_scale=SCALE_BAR)
 
-    legend_file = write_legend_and_get_path()
-    fig.legend(spec=legend_file, position="JTR+jTR+o0.2c/0.2c", box="+gwhite+p0.5p")
-    try:
-        os.remove(legend_file)
-    except OSError:
-        pass
+    fig.legend(spec=io.StringIO(_LEGEND_SPEC), position="JTR+jTR+o0.2c/0.2c", box="+gwhite+p0.5p")
 
     # Show & save
     fig.show()
     if SAVE:
         os.makedirs(SAVE_PATH, exist_ok=True)
         out = os.path.join(SAVE_PATH, FNAME)
-        fig.savefig(out, dpi=450)
+        fig.savefig(out, dpi=SAVE_DPI)
         print(f"Saved: {out}")
+        # Only cache renders made with the preferred topo grid, so a fallback
+        # (coarser grid or coast basemap) is retried on the next run
+        if topo_res == _topo_order(region)[0]:
+            cached_out = _map_cache_path(region, infra)
+            if cached_out is not None:
+                _store_map_cache(out, cached_out)
 
 
 if __name__ == "__main__":